@@ -1,106 +1,295 @@
+import asyncio
+import hashlib
+import io
+import json
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TypedDict
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from PIL import Image
 import gradio as gr
 
+# The analyst instructions are identical on every request, so they live in module-level
+# constants sent as each model's system instruction, ahead of the image. At a few hundred tokens
+# they are far below the minimum size for explicit context caching, so we rely on implicit
+# caching of these byte-identical prefixes instead.
+DESCRIPTION_PROMPT: str = """\
+You are an expert image analyst. Your task is to analyze the provided image and give a structured response with two distinct parts.
+Your response must use Markdown for formatting (e.g., **bold** headings).
+
+1.  **Detailed Description:**
+    Provide a detailed, multi-sentence paragraph describing the image. Mention the main subject, the setting, colors, mood, and any important details.
+
+2.  **Origin & Location Identification:**
+    Analyze if the image contains a recognizable real-world landmark, or if it is a famous piece of art, photograph, or internet meme. If you identify a specific place or work, state its name and origin (e.g., "Eiffel Tower, Paris, France" or "The Mona Lisa by Leonardo da Vinci"). If it's a generic scene, state "This appears to be a generic location or object."
+"""
+
+AI_DETECTION_PROMPT: str = """\
+You are an expert at detecting AI-generated images.
+Carefully examine the provided image for signs of being AI-generated (e.g., unnatural textures, errors in details like hands or text, overly perfect composition). Estimate the likelihood, as a percentage between 0 and 100, that this image was created by an AI.
+"""
+
+# The AI-likelihood answer comes back as JSON, so the model spends no tokens on formatting
+# and the percentage needs no parsing out of free text
+class AIDetection(TypedDict):
+    ai_likelihood: int
+
 # --- 1. Configuration and Setup (No Changes) ---
 load_dotenv()
 try:
     api_key = os.environ["GOOGLE_API_KEY"]
     if not api_key:
         raise ValueError("API key is empty. Please check your .env file.")
-    genai.configure(api_key=api_key)
-    print("Gemini API configured successfully.")
 except (KeyError, ValueError) as e:
     print(f"ERROR: Could not configure Gemini API. {e}")
-    with gr.Blocks() as demo:
-        gr.Markdown("# 🔴 ERROR: Missing Google API Key\nPlease create a `.env` file and add your `GOOGLE_API_KEY` to it.")
-    demo.launch()
-    exit()
+    api_key = None
 
 # --- 2. Core AI and Image Processing Logic (No Changes) ---
-vision_model = genai.GenerativeModel('gemini-1.5-flash-latest')
+# The AI-likelihood estimate is a constrained classification, so it runs on the smaller, faster
+# 8B model in parallel with the description instead of lengthening one combined response.
+# The client and models are built lazily on first use, so importing this module stays cheap.
+@lru_cache(maxsize=1)
+def configure_gemini():
+    # Keep the default gRPC transport: it already multiplexes every concurrent request over one
+    # shared HTTP/2 channel, while transport="rest" is not supported by the SDK's async client.
+    genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+    print("Gemini API configured successfully.")
+
+@lru_cache(maxsize=1)
+def get_detail_model():
+    configure_gemini()
+    return genai.GenerativeModel('gemini-1.5-flash-latest', system_instruction=DESCRIPTION_PROMPT)
+
+@lru_cache(maxsize=1)
+def get_ai_detection_model():
+    configure_gemini()
+    return genai.GenerativeModel(
+        'gemini-1.5-flash-8b',
+        system_instruction=AI_DETECTION_PROMPT,
+        generation_config={"response_mime_type": "application/json", "response_schema": AIDetection},
+    )
+
+_gemini_connection_warmed_up = False
 
-def get_gemini_vision_response(image, prompt):
+async def warm_up_gemini_connection():
+    # Open the SDK's async channel (and pay the TLS handshake) before the first real analysis.
+    # count_tokens is free, and running it from Gradio's event loop binds the channel to that loop.
+    # Both models share the SDK's default async client, so warming one warms the other.
+    global _gemini_connection_warmed_up
+    if _gemini_connection_warmed_up:
+        return
+    _gemini_connection_warmed_up = True
     try:
-        response = vision_model.generate_content([prompt, image])
-        if not response.parts:
-            block_reason = "unknown"
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                block_reason = response.prompt_feedback.block_reason.name.lower().replace('_', ' ')
-            error_message = f"❌ **Analysis Blocked** ❌\n\n"\
-                            f"The image could not be processed. This is likely because it was flagged for a safety reason (e.g., it may contain inappropriate content).\n\n"\
-                            f"Reason provided by the API: **{block_reason}**"
-            return error_message
-        return response.text
+        await get_detail_model().count_tokens_async(["warmup"])
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return "An error occurred while communicating with the AI. Please try again."
+        print(f"Could not pre-warm the Gemini connection: {e}")
 
-# --- 3. The Main Function for Gradio (No Changes) ---
-def image_analyzer(image_input):
-    if image_input is None:
-        return "Please provide an image first by uploading or using the webcam."
-    pil_image = Image.fromarray(image_input)
-    prompt = """
-    You are an expert image analyst. Your task is to analyze the provided image and give a structured response with three distinct parts.
-    Your response must use Markdown for formatting (e.g., **bold** headings).
+# Gemini tiles images at 768x768 internally, so anything larger only adds upload bytes and tokens
+MAX_UPLOAD_DIMENSION = 1024
+UPLOAD_JPEG_QUALITY = 85
+
+def prepare_image_for_upload(image):
+    # Downscale and JPEG-encode the image so the request body is ~150KB instead of several MB
+    # Gradio already delivers RGB images, and convert() would copy the whole frame even then
+    upload_image = image if image.mode == "RGB" else image.convert("RGB")
+    scale = MAX_UPLOAD_DIMENSION / max(upload_image.size)
+    if scale < 1:
+        # resize() writes straight into a new, smaller image, so the caller's frame is never copied or mutated
+        new_size = (max(1, round(upload_image.width * scale)), max(1, round(upload_image.height * scale)))
+        upload_image = upload_image.resize(new_size, Image.LANCZOS, reducing_gap=2.0)
+    buffer = io.BytesIO()
+    upload_image.save(buffer, format="JPEG", quality=UPLOAD_JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+# Repeated clicks on the same snapped frame (or the same demo image) reuse the previous answer
+ANALYSIS_CACHE_SIZE = 256
+_analysis_cache = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+def get_cache_key(image_part):
+    # Exact-duplicate key over the encoded upload bytes, which are already downscaled and cheap to hash
+    return hashlib.blake2b(image_part["data"], digest_size=16).hexdigest()
+
+def prepare_image_and_cache_key(image):
+    image_part = prepare_image_for_upload(image)
+    return image_part, get_cache_key(image_part)
+
+def get_cached_analysis(cache_key):
+    with _analysis_cache_lock:
+        analysis = _analysis_cache.get(cache_key)
+        if analysis is not None:
+            _analysis_cache.move_to_end(cache_key)
+        return analysis
+
+def store_cached_analysis(cache_key, analysis):
+    with _analysis_cache_lock:
+        _analysis_cache[cache_key] = analysis
+        _analysis_cache.move_to_end(cache_key)
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
 
-    1.  **Detailed Description:**
-        Provide a detailed, multi-sentence paragraph describing the image. Mention the main subject, the setting, colors, mood, and any important details.
+FinishReason = genai.protos.Candidate.FinishReason
 
-    2.  **Origin & Location Identification:**
-        Analyze if the image contains a recognizable real-world landmark, or if it is a famous piece of art, photograph, or internet meme. If you identify a specific place or work, state its name and origin (e.g., "Eiffel Tower, Paris, France" or "The Mona Lisa by Leonardo da Vinci"). If it's a generic scene, state "This appears to be a generic location or object."
+# Gemini returns these while it is overloaded; they usually clear within a few seconds
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.DeadlineExceeded,
+)
+MAX_GEMINI_ATTEMPTS = 4
 
-    3.  **AI Generation Analysis:**
-        Carefully examine the image for signs of being AI-generated (e.g., unnatural textures, errors in details like hands or text, overly perfect composition). Provide your estimation as a percentage of the likelihood that this image was created by an AI. Format your answer exactly as: "**AI Generation Likelihood:** [a number between 0 and 100]%".
-    """
-    analysis_result = get_gemini_vision_response(pil_image, prompt)
-    return analysis_result
+async def generate_content_with_retry(model, contents, **kwargs):
+    # Retry transient failures with exponential backoff (1s, 2s, 4s) before giving up
+    for attempt in range(MAX_GEMINI_ATTEMPTS):
+        try:
+            return await model.generate_content_async(contents, **kwargs)
+        except TRANSIENT_GEMINI_ERRORS as e:
+            if attempt == MAX_GEMINI_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"Gemini is temporarily unavailable ({e}). Retrying in {delay}s...")
+            await asyncio.sleep(delay)
+
+def format_blocked_message(reason):
+    block_reason = reason.name.lower().replace('_', ' ') if reason else "unknown"
+    return f"❌ **Analysis Blocked** ❌\n\n"\
+           f"The image could not be processed. This is likely because it was flagged for a safety reason (e.g., it may contain inappropriate content).\n\n"\
+           f"Reason provided by the API: **{block_reason}**"
+
+async def get_ai_detection_response(image):
+    try:
+        response = await generate_content_with_retry(get_ai_detection_model(), [image])
+        if not response.candidates or not response.parts:
+            return None
+        ai_likelihood = min(max(int(json.loads(response.text)["ai_likelihood"]), 0), 100)
+        return f"**AI Generation Likelihood:** {ai_likelihood}%"
+    except Exception as e:
+        print(f"An unexpected error occurred during AI detection: {e}")
+        return None
+
+async def get_gemini_vision_response(image, cache_key):
+    # Start the AI-likelihood request right away so it runs while the description streams in
+    ai_detection_task = asyncio.create_task(get_ai_detection_response(image))
+    try:
+        response = await generate_content_with_retry(get_detail_model(), [image], stream=True)
+        # A blocked prompt arrives as the first chunk; iterating the stream would raise
+        # BlockedPromptException, so report it before entering the loop
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            yield format_blocked_message(response.prompt_feedback.block_reason)
+            return
+        analysis = ""
+        finish_reason = None
+        async for chunk in response:
+            if chunk.candidates:
+                finish_reason = chunk.candidates[0].finish_reason
+            if not chunk.candidates or not chunk.parts:
+                continue
+            analysis += chunk.text
+            yield analysis
+        # Only a stream that ended with STOP is a complete answer; SAFETY, RECITATION or
+        # MAX_TOKENS leave a truncated analysis that must not be cached or extended
+        if analysis and finish_reason != FinishReason.STOP:
+            reason = finish_reason.name.lower().replace('_', ' ') if finish_reason else "unknown"
+            yield analysis + f"\n\n⚠️ **Analysis Incomplete** ⚠️\n\n"\
+                             f"The response was cut short before it finished. Reason provided by the API: **{reason}**"
+        elif analysis:
+            analysis += "\n\n3.  **AI Generation Analysis:**\n    "
+            # Show that section 3 is still pending while the detection call (and any retries) finishes
+            yield analysis + "_Estimating…_"
+            ai_detection = await ai_detection_task
+            if ai_detection is not None:
+                analysis += ai_detection
+                yield analysis
+                store_cached_analysis(cache_key, analysis)
+            else:
+                yield analysis + "The AI generation analysis is unavailable right now. Please try again."
+        else:
+            yield format_blocked_message(finish_reason)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        yield "An error occurred while communicating with the AI. Please try again."
+    finally:
+        ai_detection_task.cancel()
+
+# --- 3. The Main Function for Gradio (No Changes) ---
+async def image_analyzer(image_input):
+    if image_input is None:
+        yield "Please provide an image first by uploading or using the webcam."
+        return
+    # Gradio already hands us a PIL image (decoded in its preprocessing threadpool). Resizing,
+    # JPEG-encoding and hashing it is CPU work, so it runs in a worker thread to keep the
+    # event loop free for the other in-flight streams.
+    image_part, cache_key = await asyncio.to_thread(prepare_image_and_cache_key, image_input)
+    cached_analysis = get_cached_analysis(cache_key)
+    if cached_analysis is not None:
+        yield cached_analysis
+        return
+    # Stream the partial analysis so the Markdown output fills in as tokens arrive
+    async for partial_analysis in get_gemini_vision_response(image_part, cache_key):
+        yield partial_analysis
 
 # --- 4. The Gradio User Interface Definition ---
-with gr.Blocks(theme=gr.themes.Soft(), css=".gradio-container {background-color: #f0f4f9;}") as demo:
-    gr.Markdown(
-        """
-        # 🖼️ Image to Text AI (V2.2) 📝
-        Upload an image, paste from your clipboard, or use your webcam. The AI will provide a detailed analysis.
-        """
-    )
+def build_error_interface():
+    with gr.Blocks() as demo:
+        gr.Markdown("# 🔴 ERROR: Missing Google API Key\nPlease create a `.env` file and add your `GOOGLE_API_KEY` to it.")
+    return demo
 
-    with gr.Row(variant='panel'):
-        # Input Column
-        with gr.Column(scale=1):
-            with gr.Tabs():
-                with gr.TabItem("⬆️ Upload & Paste"):
-                    # --- MODIFIED: Added 'clipboard' back to the sources ---
-                    image_upload_input = gr.Image(type="numpy", label="Upload an Image or Paste from Clipboard", sources=['upload', 'clipboard'])
+def build_interface():
+    with gr.Blocks(theme=gr.themes.Soft(), css=".gradio-container {background-color: #f0f4f9;}") as demo:
+        gr.Markdown(
+            """
+            # 🖼️ Image to Text AI (V2.2) 📝
+            Upload an image, paste from your clipboard, or use your webcam. The AI will provide a detailed analysis.
+            """
+        )
+
+        with gr.Row(variant='panel'):
+            # Input Column
+            with gr.Column(scale=1):
+                with gr.Tabs():
+                    with gr.TabItem("⬆️ Upload & Paste"):
+                        # --- MODIFIED: Added 'clipboard' back to the sources ---
+                        image_upload_input = gr.Image(type="pil", label="Upload an Image or Paste from Clipboard", sources=['upload', 'clipboard'])
                 
-                with gr.TabItem("📸 Use Webcam"):
-                    # --- MODIFIED: Polished instructions and component label for maximum clarity ---
-                    gr.Markdown("**Instructions:**\n1. Allow browser access to your camera.\n2. Look for the **\"Snap\"** button below the video and click it to capture a photo.\n3. The snapped photo will appear in the box, replacing the live video.\n4. Click the \"Analyze Image\" button below.")
-                    image_webcam_input = gr.Image(type="numpy", label="Step 1: Click \"Snap\" Below to Take Photo", sources=["webcam"])
+                    with gr.TabItem("📸 Use Webcam"):
+                        # --- MODIFIED: Polished instructions and component label for maximum clarity ---
+                        gr.Markdown("**Instructions:**\n1. Allow browser access to your camera.\n2. Look for the **\"Snap\"** button below the video and click it to capture a photo.\n3. The snapped photo will appear in the box, replacing the live video.\n4. Click the \"Analyze Image\" button below.")
+                        image_webcam_input = gr.Image(type="pil", label="Step 1: Click \"Snap\" Below to Take Photo", sources=["webcam"])
             
-            analyze_button = gr.Button("Step 2: Analyze Image", variant="primary")
-
-        # Output Column
-        with gr.Column(scale=1):
-            text_output = gr.Markdown(
-                label="AI Analysis",
-                value="The AI's analysis will appear here...",
-            )
-
-    # Logic to handle inputs (No Changes)
-    def get_image_from_any_input(img_from_upload, img_from_webcam):
-        image_to_analyze = img_from_upload if img_from_upload is not None else img_from_webcam
-        return image_analyzer(image_to_analyze)
-
-    analyze_button.click(
-        fn=get_image_from_any_input,
-        inputs=[image_upload_input, image_webcam_input],
-        outputs=text_output
-    )
+                analyze_button = gr.Button("Step 2: Analyze Image", variant="primary")
+
+            # Output Column
+            with gr.Column(scale=1):
+                text_output = gr.Markdown(
+                    label="AI Analysis",
+                    value="The AI's analysis will appear here...",
+                )
+
+        # Logic to handle inputs (No Changes)
+        async def get_image_from_any_input(img_from_upload, img_from_webcam):
+            image_to_analyze = img_from_upload if img_from_upload is not None else img_from_webcam
+            async for partial_analysis in image_analyzer(image_to_analyze):
+                yield partial_analysis
+
+        # The first page load (the auto-opened browser tab) warms up the Gemini connection
+        demo.load(fn=warm_up_gemini_connection, inputs=None, outputs=None, queue=False)
+
+        analyze_button.click(
+            fn=get_image_from_any_input,
+            inputs=[image_upload_input, image_webcam_input],
+            outputs=text_output
+        )
+    return demo
+
+# Without an API key the app only shows the error page; either way nothing launches on import
+demo = build_interface() if api_key else build_error_interface()
 
 # --- 5. Launch the Application (No Changes) ---
 if __name__ == "__main__":
-    demo.launch(inbrowser=True)
\ No newline at end of file
+    # Each analysis is mostly waiting on Gemini network I/O, so many can run at once;
+    # max_size makes Gradio reject new requests with a "queue is full" error instead of piling up
+    demo.queue(default_concurrency_limit=16, max_size=100).launch(inbrowser=True, max_threads=40)
\ No newline at end of file